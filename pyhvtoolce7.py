@@ -22,35 +22,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import mmap
+import struct
 import sys
 
-class Unpacker:
-    def __init__(self, data):
-        self.data = data
-        self.index = 0
-
-    def seek(self, new_index):
-        if new_index not in range(len(self.data)+1):
-            raise IndexError("out of bounds")
-        self.index = new_index
-
-    def remaining_len(self):
-        return len(self.data) - self.index
-
-    def read_n(self, n):
-        if n > self.remaining_len():
-            raise IndexError("out of bounds")
-        res = self.data[self.index : self.index + n]
-        self.index += n
-        return res
-
-    def _read_int(self, num_bytes, endian, signed=False):
-        return int.from_bytes(self.read_n(num_bytes), endian, signed=signed)
-
-    def read_u8(self): return self.read_n(1)[0]
-    def read_u16le(self): return self._read_int(2, 'little', signed=False)
-    def read_u32le(self): return self._read_int(4, 'little', signed=False)
-
 # See also: https://github.com/nlitsme/hvtool/
 ENTRY_TYPE_NUMBER_FROM_NAME = {
     "ET_DATABASE" : 0x7,
@@ -63,7 +39,12 @@ ENTRY_TYPE_NUMBER_FROM_NAME = {
     "ET_INDEX"    : 0xe,
 }
 
-ENTRY_TYPE_NAME_FROM_NUMBER = {v:k for k,v in ENTRY_TYPE_NUMBER_FROM_NAME.items()}
+ENTRY_TYPE_NAME_FROM_NUMBER = {v:sys.intern(k) for k,v in ENTRY_TYPE_NUMBER_FROM_NAME.items()}
+
+# interned, so entry types can be compared with "is"
+_ET_ROOTS_STR = ENTRY_TYPE_NAME_FROM_NUMBER[ENTRY_TYPE_NUMBER_FROM_NAME["ET_ROOTS"]]
+_ET_KEY_STR   = ENTRY_TYPE_NAME_FROM_NUMBER[ENTRY_TYPE_NUMBER_FROM_NAME["ET_KEY"]]
+_ET_VALUE_STR = ENTRY_TYPE_NAME_FROM_NUMBER[ENTRY_TYPE_NUMBER_FROM_NAME["ET_VALUE"]]
 
 VALUE_TYPE_STRING     = 1
 VALUE_TYPE_BINARY     = 3
@@ -74,194 +55,258 @@ VALUE_TYPE_MUI        = 21
 # See also: <https://en.wikipedia.org/wiki/Windows_Registry#Root_keys>
 ROOT_NAME_FROM_INDEX = ["HKCR", "HKCU", "HKLM", "HKU"] # indices matter
 
+Entry     = collections.namedtuple("Entry", "type data")
+KeyData   = collections.namedtuple("KeyData", "name next_sibling first_child first_value flags")
+ValueData = collections.namedtuple("ValueData", "name value next")
+
+_HDR    = struct.Struct("<III16sIII16s172xIIII24x") # file header
+_SECLST = struct.Struct("<4096I") # section offsets, 0x1000 to 0x5000
+_SECHDR = struct.Struct("<III")
+_SECTAB = struct.Struct("<1024I") # 0x400 entry headers per section
+_ENTHDR = struct.Struct("<III")
+_KEYHDR = struct.Struct("<IIIBHB")
+_VALHDR = struct.Struct("<IHHH")
+_ROOTS  = struct.Struct("<8I")
+_U32    = struct.Struct("<I")
+
+# dict_keys.isdisjoint stops at the first shared key and builds no sets
+def _collides(a, b):
+    return not a.keys().isdisjoint(b)
+
+# Each stack item carries the ids of the entries above it, a child that is
+# one of those is a cycle. The same entry may still be reached from two places.
+def _flatmap_roots(res_dict, prefix, entry_id, ancestors, stack):
+    ancestors = ancestors | {entry_id}
+    root_list = [(prefix + "/" + ROOT_NAME_FROM_INDEX[root_index], root_id, ancestors)
+                 for root_index,root_id in enumerate(res_dict[entry_id].data)]
+    stack.extend(reversed(root_list))
+    return dict()
+
+def _flatmap_values(res_dict, prefix, entry_id, ancestors, stack):
+    res = dict()
+    chain = set() # catches a "next" loop
+    while entry_id != 0:
+        entry = res_dict.get(entry_id)
+        if entry is None:
+            break
+        if entry.type is not _ET_VALUE_STR or entry_id in chain:
+            raise ValueError() # bug
+        chain.add(entry_id)
+        entry_data = entry.data
+        entry_name = entry_data.name
+        if entry_name in res:
+            raise ValueError() # bug
+        res[prefix + "/" + entry_name] = entry_data.value
+        entry_id  = entry_data.next
+    return res
+
+def _flatmap_keys(res_dict, prefix, entry_id, ancestors, stack):
+    child_list = []
+    chain = set() # catches a "next_sibling" loop
+    while entry_id != 0:
+        entry = res_dict.get(entry_id)
+        if entry is None:
+            break
+        if entry.type is not _ET_KEY_STR or entry_id in chain or entry_id in ancestors:
+            raise ValueError() # bug
+        chain.add(entry_id)
+        entry_data = entry.data
+        entry_name = entry_data.name
+        path = prefix + "/" + entry_name
+        child_ancestors = ancestors | {entry_id}
+
+        first_child = entry_data.first_child
+        if first_child != 0:
+            child_list.append((path, first_child, child_ancestors))
+        first_value = entry_data.first_value
+        if first_value != 0:
+            child_list.append((path, first_value, child_ancestors))
+
+        entry_id = entry_data.next_sibling
+    stack.extend(reversed(child_list)) # keep the order of the keys in the hive
+    return dict()
+
+_FLATMAP_HANDLERS = {
+    _ET_ROOTS_STR : _flatmap_roots,
+    _ET_VALUE_STR : _flatmap_values,
+    _ET_KEY_STR   : _flatmap_keys,
+}
+
 def make_reg_flatmap(res_dict, prefix, entry_id):
-    if entry_id not in res_dict:
-        return dict()
-    entry_type = res_dict[entry_id]["type"]
-    if entry_type == "ET_ROOTS":
-        res = dict()
-        for root_index,root_id in enumerate(res_dict[entry_id]["data"]):
-            root_name = ROOT_NAME_FROM_INDEX[root_index]
-            x = make_reg_flatmap(res_dict, prefix + "/" + root_name, root_id)
-            if len(set(x.keys()).intersection(res.keys())) != 0:
-                raise NotImplementedError()
-            res.update(x)
-        return res
-    elif entry_type == "ET_VALUE":
-        res = dict()
-        while entry_id != 0 and entry_id in res_dict:
-            if res_dict[entry_id]["type"] != "ET_VALUE":
-                raise ValueError() # bug
-            entry_data = res_dict[entry_id]["data"]
-            entry_name = entry_data["name"]
-            if entry_name in res:
-                raise ValueError() # bug
-            res[prefix + "/" + entry_name] = entry_data["value"]
-            entry_id  = entry_data["next"]
-        return res
-    elif entry_type == "ET_KEY":
-        res = dict()
-        while entry_id != 0 and entry_id in res_dict:
-            if res_dict[entry_id]["type"] != "ET_KEY":
-                raise ValueError() # bug
-            entry_data = res_dict[entry_id]["data"]
-            entry_name = entry_data["name"]
-            path = prefix + "/" + entry_name
-
-            children = dict()
-            if entry_data["first_child"] != 0:
-                children = make_reg_flatmap(res_dict, path, entry_data["first_child"])
-            if entry_data["first_value"] != 0:
-                values = make_reg_flatmap(res_dict, path, entry_data["first_value"])
-                if len(set(values.keys()).intersection(children.keys())) != 0:
-                    raise ValueError() # bug
-                children.update(values)
-
-            if len(set(children.keys()).intersection(res.keys())) != 0:
-                raise ValueError() # bug
-
-            res.update(children)
-
-            entry_id = entry_data["next_sibling"]
-
-        return res
-    else:
+    res = dict()
+    stack = [(prefix, entry_id, frozenset())] # explicit stack, deep hives could hit the recursion limit
+    while stack:
+        prefix, entry_id, ancestors = stack.pop()
+        entry = res_dict.get(entry_id)
+        if entry is None:
+            continue
+        entry_type = entry.type
+        if entry_type not in _FLATMAP_HANDLERS:
+            raise NotImplementedError()
+        if entry_id in ancestors:
+            raise ValueError() # bug
+        x = _FLATMAP_HANDLERS[entry_type](res_dict, prefix, entry_id, ancestors, stack)
+        if _collides(res, x):
+            raise ValueError() # bug
+        res.update(x)
+    return res
+
+# The parsers read the entry in place, at data[rawdata_start : rawdata_start + rawdata_len].
+def _parse_roots(data, rawdata_start, rawdata_len):
+    if _ROOTS.size > rawdata_len:
+        raise IndexError("out of bounds")
+    root_ids = _ROOTS.unpack_from(data, rawdata_start)
+    return [x for x in root_ids if x]
+
+def _parse_key(data, rawdata_start, rawdata_len):
+    if _KEYHDR.size > rawdata_len:
+        raise IndexError("out of bounds")
+    (next_sibling, first_child, first_value,
+     name_len, flags, _) = _KEYHDR.unpack_from(data, rawdata_start)
+
+    name_start = rawdata_start + _KEYHDR.size
+    name_end   = name_start + name_len*2
+    if name_end > rawdata_start + rawdata_len:
+        raise IndexError("out of bounds")
+    name = str(data[name_start : name_end], "utf-16-le")
+    return KeyData(name, next_sibling, first_child, first_value, flags)
+
+def _parse_value(data, rawdata_start, rawdata_len):
+    if _VALHDR.size > rawdata_len:
+        raise IndexError("out of bounds")
+    (value_next, value_type, value_value_len,
+     value_name_len_and_stuff) = _VALHDR.unpack_from(data, rawdata_start)
+
+    value_name_len = value_name_len_and_stuff & 0xFF
+    name_start = rawdata_start + _VALHDR.size
+    name_end   = name_start + value_name_len*2
+    value_end  = name_end + value_value_len
+    if value_end > rawdata_start + rawdata_len:
+        raise IndexError("out of bounds")
+    value_name = str(data[name_start : name_end], "utf-16-le")
+    raw_value  = data[name_end : value_end]
+
+    interpreted_value = None
+
+    if value_type == VALUE_TYPE_DWORD:
+        if len(raw_value) == _U32.size:
+            interpreted_value = _U32.unpack(raw_value)[0]
+        else: # odd-sized, keep reading it as a little-endian int
+            interpreted_value = int.from_bytes(raw_value, 'little')
+    elif value_type in [VALUE_TYPE_BINARY, 0x0]: # TODO 0x0 => "blob"?
+        interpreted_value = bytes(raw_value)
+    elif value_type == VALUE_TYPE_STRING:
+        raw_value = bytes(raw_value)
+        end = raw_value.find(b"\0\0") # null-terminated, unless it fills the value
+        while end != -1 and end % 2 != 0: # must be at a wide char boundary
+            end = raw_value.find(b"\0\0", end + 1)
+        if end == -1:
+            if len(raw_value) % 2 != 0: # no terminator and half a wide char at the end
+                raise IndexError("out of bounds")
+            end = len(raw_value)
+        interpreted_value = raw_value[:end].decode("utf-16-le")
+    elif value_type == VALUE_TYPE_MUI:
         raise NotImplementedError()
+    elif value_type == VALUE_TYPE_STRINGLIST: # "\0"-separated list of string
+        interpreted_value = str(raw_value, "utf-16-le")
+        if not interpreted_value.endswith("\0\0"): # last string is empty
+            raise ValueError()
+        interpreted_value = interpreted_value[:-2].split("\0")
+    else:
+        raise NotImplementedError("unknown registry entry type", hex(value_type))
+    return ValueData(value_name, interpreted_value, value_next)
 
-def parse_hivefile(data):
-    p = Unpacker(data)
-
-    header_size       = p.read_u32le() # 0x400
-    _                 = p.read_u32le() # 0
-    magic             = p.read_u32le()
-    file_md5          = p.read_n(16)
-    _                 = p.read_u32le() # 0
-    file_size         = p.read_u32le()
-    file_type         = p.read_u32le() # 0x1000
-    boot_md5          = p.read_n(16)
-    _                 = p.read_n(172)  # 0 0 ... 0
-    base              = p.read_u32le() # 0xcd4f5000
-    recovery_log_size = p.read_u32le() # 0
-    is_reghive        = p.read_u32le() # 0xffffffff
-    is_dbvol          = p.read_u32le() # 0
-    _                 = p.read_n(24)
+_PARSE_HANDLERS = {
+    ENTRY_TYPE_NUMBER_FROM_NAME["ET_ROOTS"] : _parse_roots,
+    ENTRY_TYPE_NUMBER_FROM_NAME["ET_KEY"]   : _parse_key,
+    ENTRY_TYPE_NUMBER_FROM_NAME["ET_VALUE"] : _parse_value,
+}
+
+# Returns (entry_id, entry_type, rawdata_start, rawdata_len) for each used entry.
+def _scan_entries(data, section_list):
+    # first gather the entry offsets of all sections, then read the entry headers
+    data_len = len(data)
+    entry_offset_list = []
+    for section_offset in section_list:
+        offset = 0x5000 + section_offset
+        if offset + _SECHDR.size + _SECTAB.size > data_len:
+            raise IndexError("out of bounds")
+        section_magic, _, _ = _SECHDR.unpack_from(data, offset)
+        if section_magic != 0x20001004:
+            raise ValueError("bad magic", section_magic)
+        section_entry_list = _SECTAB.unpack_from(data, offset + _SECHDR.size)
+
+        # most slots are null, so let filter() drop those before the test
+        entry_offset_list += [x & 0x0ffffffc for x in filter(None, section_entry_list)
+                              if x & 0b11 == 0b01 and x & 0x0ffffffc < data_len]
+
+    res = []
+    for entry_offset in entry_offset_list:
+        offset = 0x5000 + entry_offset
+        if offset + _ENTHDR.size > data_len:
+            raise IndexError("out of bounds")
+        entry_rawsize, _, entry_id = _ENTHDR.unpack_from(data, offset)
+        entry_type = entry_rawsize >> 28
+        entry_size = entry_rawsize & ~0xf0000000
 
+        offset += _ENTHDR.size
+        if offset + entry_size > data_len:
+            raise IndexError("out of bounds")
+        res.append((entry_id, entry_type, offset, entry_size))
+    return res
+
+def parse_hivefile(data):
+    data = memoryview(data)
+    if _HDR.size > len(data):
+        raise IndexError("out of bounds")
+    (header_size,       # 0x400
+     _,                 # 0
+     magic,
+     file_md5,
+     _,                 # 0
+     file_size,
+     file_type,         # 0x1000
+     boot_md5,
+     base,              # 0xcd4f5000
+     recovery_log_size, # 0
+     is_reghive,        # 0xffffffff
+     is_dbvol,          # 0
+    ) = _HDR.unpack_from(data, 0)
 
     if magic != int.from_bytes(b'EKIM', 'little'):
         raise ValueError("bad magic", magic)
 
-    p.seek(0x1000)
-
-    section_list = [p.read_u32le()] # always read the first entry even if null
-    while True:
-        section_offset = p.read_u32le()
-        if section_offset == 0: # null as stop-value
-            break
-        section_list.append(section_offset)
+    if 0x1000 + _SECLST.size > len(data):
+        raise IndexError("out of bounds")
+    section_table = _SECLST.unpack_from(data, 0x1000) + (0,)
+    # always use the first entry even if null, then null as stop-value
+    section_list = list(section_table[:section_table.index(0, 1)])
 
     entry_dict = dict()
-    for section_offset in section_list:
-        p.seek(0x5000 + section_offset)
-        section_magic = p.read_u32le()
-        if section_magic != 0x20001004:
-            raise ValueError("bad magic", magic)
-        _ = p.read_u32le()
-        _ = p.read_u32le()
-        section_entry_list = [p.read_u32le() for _ in range(0x400)]
-
-        for entry_header in section_entry_list:
-            entry_offset = entry_header & 0x0ffffffc
-            entry_flags = entry_header & 0b11
-            if entry_flags != 0b01 or entry_offset >= len(p.data):
-                continue
-
-            p.seek(0x5000 + entry_offset)
-
-            entry_rawsize = p.read_u32le()
-            entry_type = entry_rawsize >> 28
-            entry_size = entry_rawsize & ~0xf0000000
-
-            _ = p.read_u32le() # 0
-            entry_id = p.read_u32le()
-            entry_rawdata = p.read_n(entry_size)
-
-            entry_type_name = ENTRY_TYPE_NAME_FROM_NUMBER[entry_type]
-            vp = Unpacker(entry_rawdata)
-
-            if entry_type == ENTRY_TYPE_NUMBER_FROM_NAME["ET_ROOTS"]:
-                root_ids = [vp.read_u32le() for _ in range(8)]
-                entry_data = [x for x in root_ids if x != 0]
-            elif entry_type == ENTRY_TYPE_NUMBER_FROM_NAME["ET_KEY"]:
-                next_sibling = vp.read_u32le()
-                first_child  = vp.read_u32le()
-                first_value  = vp.read_u32le()
-                name_len     = vp.read_u8()
-                flags        = vp.read_u16le()
-                _            = vp.read_u8()
-
-                name = vp.read_n(name_len*2)
-                name = name.decode("utf-16")
-                entry_data = {
-                    "name"         : name,
-                    "next_sibling" : next_sibling,
-                    "first_child"  : first_child,
-                    "first_value"  : first_value,
-                    "flags"        : flags,
-                }
-            elif entry_type == ENTRY_TYPE_NUMBER_FROM_NAME["ET_VALUE"]:
-                value_next = vp.read_u32le()
-                value_type = vp.read_u16le()
-                value_value_len          = vp.read_u16le()
-                value_name_len_and_stuff = vp.read_u16le()
-
-                value_name_len = value_name_len_and_stuff & 0xFF
-                value_name = vp.read_n(value_name_len*2).decode("utf-16")
-                raw_value  = vp.read_n(value_value_len)
-
-                interpreted_value = None
-
-                if value_type == VALUE_TYPE_DWORD:
-                    interpreted_value = int.from_bytes(raw_value, 'little')
-                elif value_type in [VALUE_TYPE_BINARY, 0x0]: # TODO 0x0 => "blob"?
-                    interpreted_value = raw_value
-                elif value_type == VALUE_TYPE_STRING:
-                    wide_char_list = []
-                    vvp = Unpacker(raw_value)
-                    while vvp.remaining_len() != 0:
-                        wc = vvp.read_u16le()
-                        if wc == 0:
-                            break
-                        wide_char_list.append(wc)
-                    interpreted_value = b''.join(x.to_bytes(2, 'little')
-                            for x in wide_char_list).decode("utf-16")
-                elif value_type == VALUE_TYPE_MUI:
-                    raise NotImplementedError()
-                elif value_type == VALUE_TYPE_STRINGLIST: # "\0"-separated list of string
-                    interpreted_value = raw_value.decode("utf-16")
-                    if not interpreted_value.endswith("\0\0"): # last string is empty
-                        raise ValueError()
-                    interpreted_value = interpreted_value[:-2].split("\0")
-                else:
-                    raise NotImplementedError("unknown registry entry type", hex(value_type))
-                entry_data = {"name": value_name, "value": interpreted_value,
-                              "next": value_next}
-            elif entry_type in ENTRY_TYPE_NAME_FROM_NUMBER.keys():
+    for entry_id, entry_type, rawdata_start, rawdata_len in _scan_entries(data, section_list):
+        handler = _PARSE_HANDLERS.get(entry_type)
+        if handler is None:
+            if entry_type in ENTRY_TYPE_NAME_FROM_NUMBER:
                 raise NotImplementedError()
-            else:
-                raise ValueError("unknown reg entry type")
-
-            entry_dict[entry_id] = {"type": entry_type_name, "data": entry_data}
+            raise ValueError("unknown reg entry type")
+        entry_type_name = ENTRY_TYPE_NAME_FROM_NUMBER[entry_type]
+        entry_dict[entry_id] = Entry(entry_type_name, handler(data, rawdata_start, rawdata_len))
 
     # XXX: the file seems to continue with a clone of the first part of the file. (backup?)
 
     flatreg = dict()
-    for entry_id in entry_dict:
-        if entry_dict[entry_id]["type"] == "ET_ROOTS":
-            flatreg.update(make_reg_flatmap(entry_dict, "", entry_id))
+    done_root_lists = set() # identical ET_ROOTS entries would give the same flatmap
+    for entry_id,entry in entry_dict.items():
+        if entry.type is not _ET_ROOTS_STR or tuple(entry.data) in done_root_lists:
+            continue
+        done_root_lists.add(tuple(entry.data))
+        flatreg.update(make_reg_flatmap(entry_dict, "", entry_id))
 
     return flatreg
 
 if __name__ == '__main__':
     [_, path] = sys.argv
-    for k,v in sorted(parse_hivefile(open(path, "rb").read()).items()):
-        print(k, repr(v))
+    with open(path, "rb") as f:
+        hive = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # parsed in place, not copied
+    flatreg = parse_hivefile(hive)
+    sys.stdout.write("".join(k + " " + repr(v) + "\n" for k,v in sorted(flatreg.items())))